@@ -6,13 +6,19 @@
 ###  Licensed under GNU General Public License v3. See file 'LICENSE'.
 
 
-import sys, os, stat, shutil, subprocess, time, datetime
-import re, mmap, zlib, gzip, tarfile, io, fcntl, tempfile
+import sys, os, stat, shutil, subprocess, time, datetime, threading, queue
+import re, mmap, zlib, gzip, tarfile, io, fcntl, tempfile, struct
+import collections, itertools, heapq, multiprocessing, concurrent.futures
 import xml.etree.ElementTree
 import argparse, configparser, hashlib, uuid
 # For deduplication tests:
-import ctypes, sqlite3, resource
+import sqlite3, resource
 from array import array
+# Optional compression modules:
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # ArchiveSet manages configuration and configured volume info
@@ -93,7 +99,6 @@ class ArchiveSet:
         if datavol in self.conf["volumes"].keys():
             x_it(1, datavol+" is already configured.")
 
-        volname_check = re.compile("^[a-zA-Z0-9\+\._-]+$")
         if volname_check.match(datavol) is None:
             x_it(1, "Only characters A-Z 0-9 . + _ - are allowed"
                 " in volume names.")
@@ -115,6 +120,7 @@ class ArchiveSet:
         for ext in {".tick",".tock"}:
             if lv_exists(self.vgname, datavol+ext):
                 do_exec([["lvremove", "-f", self.vgname+"/"+datavol+ext]])
+                del volgroups[self.vgname].lvs[datavol+ext]
                 print("Removed snapshot", self.vgname+"/"+datavol+ext)
 
         if os.path.exists(pjoin(self.path,datavol)):
@@ -132,6 +138,7 @@ class ArchiveSet:
             self.error   = False
             self.volsize = None
             self.mapfile = path+"/deltamap"
+            self.deltas  = None
             # persisted:
             self.format_ver = "0"
             self.uuid    = None
@@ -142,14 +149,14 @@ class ArchiveSet:
             # load volume info
             if os.path.exists(pjoin(path,"volinfo")):
                 with open(pjoin(path,"volinfo"), "r") as f:
-                    for ln in f:
+                    for ln in f.read().splitlines():
                         vname, value = ln.strip().split(" = ")
                         setattr(self, vname, value)
 
-            # load sessions
-            self.sessions ={e.name: self.Ses(self,e.name,pjoin(path,e.name)) \
+            # load sessions; is_dir() uses the type from the dir listing
+            self.sessions ={e.name: self.Ses(self,e.name,e.path) \
                 for e in os.scandir(path) if e.name[:2]=="S_" \
-                    and e.name[-3:]!="tmp"} ##if self.present else {}
+                    and e.name[-3:]!="tmp" and e.is_dir()}
 
             no_manifest = [ses.name for ses in self.sessions.values()
                            if not ses.present]
@@ -192,7 +199,7 @@ class ArchiveSet:
         def mapsize(self, volume_size=None):
             if not volume_size:
                 volume_size = self.volsize
-            return (volume_size // self.archive.chunksize // 8) + 1
+            return (volume_size // (self.archive.chunksize * 8)) + 1
 
         def save_volinfo(self, fname="volinfo"):
             with open(pjoin(self.path,fname), "w") as f:
@@ -216,6 +223,8 @@ class ArchiveSet:
             self.last = sname
             self.sesnames.append(sname)
             self.sessions[sname] = ns
+            # Newest session goes last; dedup indexes refer to sessions
+            # by their position in allsessions.
             self.archive.allsessions.append(ns)
             return ns
 
@@ -241,7 +250,8 @@ class ArchiveSet:
             def __init__(self, volume, name, path=""):
                 self.name     = name
                 self.path     = path
-                self.present  = os.path.exists(pjoin(path,"manifest"))
+                self.present  = bool(path) and \
+                                os.path.exists(pjoin(path,"manifest"))
                 self.volume   = volume
                 # persisted:
                 self.localtime = None
@@ -254,7 +264,7 @@ class ArchiveSet:
 
                 if path:
                     with open(pjoin(path,"info"), "r") as sf:
-                        for ln in sf:
+                        for ln in sf.read().splitlines():
                             vname, value = ln.strip().split(" = ")
                             setattr(self, vname, 
                                 int(value) if vname in attr_int else value)
@@ -281,32 +291,33 @@ class Lvm_VolGroup:
 class Lvm_Volume:
     colnames  = ["vg_name","lv_name","lv_attr","lv_size","lv_time",
                  "pool_lv","thin_id","lv_path"]
-    attr_ints = ["lv_size"]
+    attr_ints = {"lv_size"}
+    non_digit = re.compile("[^0-9]")
 
     def __init__(self, members):
-        for attr in self.colnames:
-            val = members[self.colnames.index(attr)]
-            setattr(self, attr, int(re.sub("[^0-9]", "", val)) if attr \
+        for attr, val in zip(self.colnames, members):
+            setattr(self, attr, int(self.non_digit.sub("", val)) if attr \
                 in self.attr_ints else val)
 
 
-# Retrieves survey of all LVs as vgs[].lvs[] dicts
+# Retrieves survey of all LVs as vgs[].lvs[] dicts.
+# The result is kept in 'volgroups'; code that creates or removes LVs
+# should update it or survey again.
 
 def get_lvm_vgs():
 
-    do_exec([["lvs", "--units=b", "--noheadings", "--separator=::",
-                "--options=" + ",".join(Lvm_Volume.colnames)]],
-            out=tmpdir+"/volumes.lst")
+    lvs_out = subprocess.check_output(["lvs", "--units=b", "--noheadings",
+                "--separator=::", "--options=" + ",".join(Lvm_Volume.colnames)],
+                stderr=subprocess.DEVNULL)
 
     vgs = {}
-    with open(tmpdir+"/volumes.lst", "r") as vlistf:
-        for ln in vlistf:
-            members = ln.strip().split("::")
-            vgname = members[0] # Fix: use colname index
-            lvname = members[1]
-            if vgname not in vgs.keys():
-                vgs[vgname] = Lvm_VolGroup(vgname)
-            vgs[vgname].lvs[lvname] = Lvm_Volume(members)
+    for ln in lvs_out.decode("UTF-8").splitlines():
+        members = ln.strip().split("::")
+        vgname = members[0] # Fix: use colname index
+        lvname = members[1]
+        if vgname not in vgs.keys():
+            vgs[vgname] = Lvm_VolGroup(vgname)
+        vgs[vgname].lvs[lvname] = Lvm_Volume(members)
 
     return vgs
 
@@ -346,12 +357,15 @@ def arch_init(aset):
         aset.destdir    = options.subdir.strip()
 
     if options.compression:
-        if ":" in options.compression:
-            compression, compr_level = options.compression.strip().split(":")
-            aset.compr_level = compr_level
-        if compression not in {"zlib"}:
+        compression, delim, compr_level \
+                = options.compression.strip().partition(":")
+        if compression not in {"zlib","zstd"} or (delim and not compr_level):
             x_it(1, "Invalid compression spec.")
+        if compression == "zstd" and zstandard is None:
+            x_it(1, "zstd compression requires the Python 'zstandard' module.")
         aset.compression = compression
+        if compr_level:
+            aset.compr_level = compr_level
 
     if options.chfactor:
         aset.chunksize = int(options.chfactor) * bkchunksize
@@ -432,13 +446,30 @@ def detect_internal_state():
 cmd = sys.argv[1]
 with open("''' + tmpdir + '''/rpc/dest.lst", "r") as lstf:
     if cmd == "receive":
+        outf = sys.stdout.buffer; outfd = outf.fileno()
+        use_sendfile = hasattr(os, "sendfile")
         for line in lstf:
             fname = line.strip()
             fsize = os.path.getsize(fname) if os.path.exists(fname) else 0
-            i = sys.stdout.buffer.write(fsize.to_bytes(4,"big"))
+            i = outf.write(fsize.to_bytes(4,"big"))
             if fsize:
                 with open(fname,"rb") as dataf:
-                    i = sys.stdout.buffer.write(dataf.read(fsize))
+                    # Let the kernel copy chunk data straight to stdout.
+                    pos = 0
+                    if use_sendfile:
+                        outf.flush()
+                        try:
+                            while pos < fsize:
+                                sent = os.sendfile(outfd, dataf.fileno(),
+                                                   pos, fsize-pos)
+                                if not sent:
+                                    raise EOFError(fname)
+                                pos += sent
+                        except OSError:
+                            use_sendfile = False
+                    if pos < fsize:
+                        dataf.seek(pos)
+                        i = outf.write(dataf.read(fsize-pos))
     elif cmd == "merge":
         merge_target, target = lstf.readline().strip().split()
         src_list = []
@@ -447,19 +478,19 @@ with open("''' + tmpdir + '''/rpc/dest.lst", "r") as lstf:
             if ln == "###":
                 break
             src_list.append(ln)
-        subdirs = set()
-        for src in src_list:
-            for i in os.scandir(src):
-                if i.is_dir():
-                    subdirs.add(i.name)
+        subdirs = {i.name for src in src_list for i in os.scandir(src)
+                   if i.is_dir()}
         for sdir in subdirs:
             os.makedirs(merge_target+"/"+sdir, exist_ok=True)
         for line in lstf:
             ln = line.strip().split()
-            if ln[0] == "rename" and os.path.exists(ln[1]):
-                os.replace(ln[1], ln[2])
-            elif ln[0] == "rm" and os.path.exists(ln[1]):
-                os.remove(ln[1])
+            try:
+                if ln[0] == "rename":
+                    os.replace(ln[1], ln[2])
+                elif ln[0] == "rm":
+                    os.remove(ln[1])
+            except FileNotFoundError:
+                pass
         for dir in src_list:
             shutil.rmtree(dir)
         os.replace(merge_target, target)
@@ -605,6 +636,19 @@ def dest_run_args(dest_type, commands):
     return ret
 
 
+# Enlarge the kernel buffer of pipe file 'f' to reduce write calls and
+# reader wakeups. Size is capped by the system limit; on failure the
+# default size remains.
+
+def set_pipe_size(f, size=1024*1024):
+    try:
+        with open("/proc/sys/fs/pipe-max-size") as mf:
+            size = min(size, int(mf.read()))
+        fcntl.fcntl(f.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), size)
+    except (OSError, ValueError):
+        pass
+
+
 # Prepare snapshots and check consistency with metadata.
 # Must run get_lvm_vgs() again after this.
 
@@ -636,6 +680,7 @@ def prepare_snapshots(datavols):
         if lv_exists(vgname, snap2vol):
             p = subprocess.check_output(["lvremove", "-f",vgname+"/"+snap2vol],
                                         stderr=subprocess.STDOUT)
+            del volgroups[vgname].lvs[snap2vol]
 
         # Future: Expand recovery to start send-resume
         if os.path.exists(mapfile+"-tmp"):
@@ -699,13 +744,19 @@ def get_lvm_deltas(datavols):
         snap1vol = datavol + ".tick"
         snap2vol = datavol + ".tock"
         try:
-            do_exec([["thin_delta", "-m",
+            # Parse thin_delta output directly from its pipe.
+            tdelta = subprocess.Popen(["thin_delta", "-m",
                       "--thin1=" + l_vols[snap1vol].thin_id,
                       "--thin2=" + l_vols[snap2vol].thin_id,
                       "/dev/mapper/"+vgname+"-"+poolname+"_tmeta"],
-                     ["grep", "-v", "<same .*\/>$"]
-                    ],  out=tmpdir+"/delta."+datavol
-                   )
+                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            try:
+                aset.vols[datavol].deltas = get_delta_ranges(tdelta.stdout)
+            finally:
+                tdelta.stdout.close()
+                if tdelta.wait() != 0:
+                    raise subprocess.CalledProcessError(tdelta.returncode,
+                                                        tdelta.args)
         except:
             err = True
             break
@@ -717,6 +768,57 @@ def get_lvm_deltas(datavols):
         x_it(1, "ERROR running thin_delta process.")
 
 
+# get_delta_ranges: Reads thin_delta XML from a file object and returns
+# the [first, last] ranges of volume segments (chunks) which changed,
+# along with counts of changed and discarded disk blocks.
+
+def get_delta_ranges(xmlf):
+
+    seg_blocks  = aset.chunksize // bs
+    seg_ranges  = []
+    dnewblocks  = 0
+    dfreedblocks = 0
+
+    # Stream the delta XML, discarding each entry after it has been read
+    # so the whole document is never held in memory.
+    for event, delta in xml.etree.ElementTree.iterparse(
+                        xmlf, events=("start","end")):
+        if event == "start":
+            if delta.tag == "superblock":
+                dblocksize = int(delta.get("data_block_size"))
+            elif delta.tag == "diff":
+                dlist = delta
+            continue
+        elif delta.tag in {"superblock", "diff"}:
+            continue
+
+        dlist.clear()
+        blockbegin = int(delta.get("begin")) * dblocksize
+        blocklen   = int(delta.get("length")) * dblocksize
+        if delta.tag in {"different", "right_only"}:
+            dnewblocks += blocklen
+        elif delta.tag == "left_only":
+            dfreedblocks += blocklen
+        else: # superfluous tag
+            continue
+
+        # Block ranges are in disk blocks, with
+        # thin LVM tools constant of 512 bytes/block.
+        # dblocksize (source) and chunksize (dest) may be
+        # somewhat independant of each other, so map the range
+        # onto the span of volume segments (chunks) it touches.
+        first = blockbegin // seg_blocks
+        last  = (blockbegin+blocklen-1) // seg_blocks
+        # thin_delta lists ranges in order; fold adjoining ones together.
+        if seg_ranges and first <= seg_ranges[-1][1] + 1:
+            if last > seg_ranges[-1][1]:
+                seg_ranges[-1][1] = last
+        else:
+            seg_ranges.append([first, last])
+
+    return seg_ranges, dnewblocks, dfreedblocks
+
+
 # update_delta_digest: Translates raw lvm delta information
 # into a bitmap (actually chunk map) that repeatedly accumulates change status
 # for volume block ranges until a send command is successfully performed and
@@ -732,43 +834,13 @@ def update_delta_digest(datavol):
         return False
     snap2vol    = vol.name + ".tock"
     snap2size   = l_vols[snap2vol].lv_size
-    chunksize   = aset.chunksize
     os.rename(vol.mapfile, vol.mapfile+"-tmp")
-    dtree       = xml.etree.ElementTree.parse(tmpdir+"/delta."+datavol).getroot()
-    dblocksize  = int(dtree.get("data_block_size"))
-    bmap_byte   = 0
-    lastindex   = 0
-    dnewblocks  = 0
-    dfreedblocks = 0
+    seg_ranges, dnewblocks, dfreedblocks = vol.deltas
 
     with open(vol.mapfile+"-tmp", "r+b") as bmapf:
         os.ftruncate(bmapf.fileno(), vol.mapsize(snap2size))
         bmap_mm = mmap.mmap(bmapf.fileno(), 0)
-
-        for delta in dtree.find("diff"):
-            blockbegin = int(delta.get("begin")) * dblocksize
-            blocklen   = int(delta.get("length")) * dblocksize
-            if delta.tag in {"different", "right_only"}:
-                dnewblocks += blocklen
-            elif delta.tag == "left_only":
-                dfreedblocks += blocklen
-            else: # superfluous tag
-                continue
-
-            # blockpos iterates over disk blocks, with
-            # thin LVM tools constant of 512 bytes/block.
-            # dblocksize (source) and chunksize (dest) may be
-            # somewhat independant of each other.
-            for blockpos in range(blockbegin, blockbegin + blocklen):
-                volsegment = blockpos // (chunksize // bs)
-                bmap_pos = volsegment // 8
-                if bmap_pos != lastindex:
-                    bmap_mm[lastindex] |= bmap_byte
-                    bmap_byte = 0
-                bmap_byte |= 1 << (volsegment % 8)
-                lastindex = bmap_pos
-
-        bmap_mm[lastindex] |= bmap_byte
+        set_bmap_ranges(bmap_mm, seg_ranges)
 
     if monitor_only and dnewblocks+dfreedblocks > 0:
         print(dnewblocks * bs, "changed,",
@@ -779,10 +851,189 @@ def update_delta_digest(datavol):
     return dnewblocks+dfreedblocks > 0
 
 
+# Turn on deltamap bits for each [first, last] range of volume segments.
+# Partial bytes at either end of a range are masked in; whole bytes in
+# between are filled with a single slice assignment.
+
+def set_bmap_ranges(bmap_mm, seg_ranges):
+    for first, last in seg_ranges:
+        fbyte = first // 8; lbyte = last // 8
+        head  = (0xff << (first % 8)) & 0xff
+        tail  = 0xff >> (7 - last % 8)
+        if fbyte == lbyte:
+            bmap_mm[fbyte] |= head & tail
+            continue
+        bmap_mm[fbyte] |= head
+        if lbyte - fbyte > 1:
+            bmap_mm[fbyte+1:lbyte] = b"\xff" * (lbyte-fbyte-1)
+        bmap_mm[lbyte] |= tail
+
+
 def last_chunk_addr(volsize, chunksize):
     return (volsize-1) - ((volsize-1) % chunksize)
 
 
+# Return a function that compresses a chunk buffer.
+
+def get_compressor(compression, level):
+    if compression == "zlib":
+        return lambda data: zlib.compress(data, level)
+    elif compression == "zstd":
+        # Frame must carry content size; receive checks it before decompress.
+        return zstandard.ZstdCompressor(level=level, write_content_size=True,
+                                        write_checksum=False).compress
+    raise ValueError("Unknown compression type: "+compression)
+
+
+# Return a function that decompresses a chunk of up to 'chunksize' bytes.
+# Safe to call from several threads at once.
+
+def get_decompressor(compression, chunksize):
+    if compression in {"zlib","gzip"}:
+        wbits = 32 + zlib.MAX_WBITS    # accept zlib or gzip header
+        return lambda data: zlib.decompress(data, wbits, chunksize)
+    elif compression == "zstd":
+        # Decompressor objects aren't thread safe; keep one per thread
+        # so its context is set up only once.
+        local = threading.local()
+
+        def zstd_decompress(data):
+            # Don't let a frame header request more than one chunk.
+            if zstandard.frame_content_size(data) > chunksize:
+                raise BufferError("Bad zstd frame size.")
+            try:
+                dctx = local.dctx
+            except AttributeError:
+                dctx = local.dctx = zstandard.ZstdDecompressor()
+            return dctx.decompress(data, max_output_size=chunksize)
+
+        return zstd_decompress
+    raise ValueError("Unknown compression type: "+compression)
+
+
+# Chunk compression and hashing run in worker processes, each with its
+# own compressor.
+
+def init_compress_worker(compression, level):
+    global worker_compress
+    worker_compress = get_compressor(compression, level)
+
+def compress_worker(buf):
+    buf = worker_compress(buf)
+    return buf, hashlib.sha256(buf).digest()
+
+
+# Yield addresses of chunks flagged in deltamap 'bmap' below 'sendall_addr',
+# then every chunk from there to 'size'. Only runs of non-zero bytes in the
+# map are visited, found with a regex search.
+
+def bmap_addrs(bmap, chunksize, size, sendall_addr):
+    limit = min(size, sendall_addr)
+    bits  = [[b for b in range(8) if v & (1 << b)] for v in range(256)]
+
+    def flagged():
+        for m in bmap_nonzero.finditer(bmap):
+            for pos in range(m.start(), m.end()):
+                for b in bits[bmap[pos]]:
+                    yield (pos*8 + b) * chunksize
+
+    for addr in flagged():
+        if addr >= limit:
+            break
+        yield addr
+    yield from range(sendall_addr, size, chunksize)
+
+
+# Pass through addresses from 'addrs' with a lag of 'ahead', asking the
+# kernel to start reading each chunk as it enters the window.
+
+def prefetch_addrs(fd, addrs, chunksize, ahead):
+    window = collections.deque()
+    for addr in addrs:
+        os.posix_fadvise(fd, addr, chunksize, os.POSIX_FADV_WILLNEED)
+        window.append(addr)
+        if len(window) > ahead:
+            yield window.popleft()
+    yield from window
+
+
+# Read chunks at addresses 'addrs' from volume file 'vf' and compress them
+# in a pool of worker processes, while the caller streams earlier results.
+# Yields (addr, buf, digest) in address order, with buf = digest = None for
+# an empty chunk that precedes the last chunk. In-flight chunks are limited
+# by 'depth'.
+# Reads are prefetched a few MB ahead, and chunks are dropped from the
+# page cache once read, as a backup would otherwise evict more useful
+# cached data.
+
+def compress_chunks(vf, addrs, chunksize, lchunk_addr):
+
+    zeros   = bytes(chunksize)
+    vf_fd   = vf.fileno()
+    fadvise = os.posix_fadvise; pread = os.pread
+    os.posix_fadvise(vf_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    workers = os.cpu_count() or 1
+    depth   = max(2, min(workers * 4, (64 * 1024 * 1024) // chunksize))
+    pending = collections.deque()
+
+    # Fail here on a bad compression type; an error in the pool initializer
+    # would only make the pool respawn workers forever.
+    get_compressor(aset.compression, int(aset.compr_level))
+
+    # fork: a fresh interpreter would re-run this script's main section.
+    pool = multiprocessing.get_context("fork").Pool(workers,
+           initializer=init_compress_worker,
+           initargs=(aset.compression, int(aset.compr_level)))
+    with pool:
+        for addr in prefetch_addrs(vf_fd, addrs, chunksize,
+                                   max(4, (4 * 1024 * 1024) // chunksize)):
+            buf = pread(vf_fd, chunksize, addr)
+            fadvise(vf_fd, addr, chunksize, os.POSIX_FADV_DONTNEED)
+            if buf == zeros and addr < lchunk_addr:
+                pending.append((addr, None))
+            else:
+                pending.append((addr, pool.apply_async(compress_worker, (buf,))))
+
+            if len(pending) >= depth:
+                addr, job = pending.popleft()
+                yield (addr,) + (job.get() if job else (None, None))
+
+        while pending:
+            addr, job = pending.popleft()
+            yield (addr,) + (job.get() if job else (None, None))
+
+
+# Add chunk 'buf' to tar stream 'tarf', or a hard link if tarinfo has
+# LNKTYPE. Chunk headers only differ in name, size, type and linkname, so
+# these are patched into 'tmpl', a header made once by tarfile; entries are
+# also not kept in tarf.members. Names too long for the header fields go
+# through tarfile.addfile().
+
+def tar_add_chunk(tarf, tmpl, tarinfo, buf):
+    name = tarinfo.name.encode(); link = tarinfo.linkname.encode()
+    size = 0 if tarinfo.type == tarfile.LNKTYPE else len(buf)
+    if len(name) > 100 or len(link) > 100:
+        tarinfo.size = size
+        tarf.addfile(tarinfo, io.BytesIO(buf) if size else None)
+        return
+
+    hdr = bytearray(tmpl)
+    hdr[:len(name)] = name
+    if link:
+        hdr[156:157] = tarfile.LNKTYPE; hdr[157:157+len(link)] = link
+    hdr[124:136] = b"%011o\0" % size
+    hdr[148:156] = b" " * 8
+    hdr[148:155] = b"%06o\0" % sum(hdr)
+    pad = -size % tarfile.BLOCKSIZE
+
+    tarf.fileobj.write(hdr)
+    if size:
+        tarf.fileobj.write(buf)
+        if pad:
+            tarf.fileobj.write(bytes(pad))
+    tarf.offset += len(hdr) + size + pad
+
+
 # Send volume to destination:
 
 def send_volume(datavol, localtime):
@@ -799,42 +1050,50 @@ def send_volume(datavol, localtime):
     sdir        = pjoin(datavol, bksession)
     send_all    = len(vol.sessions) == 0
 
+    if aset.compression == "zstd" and zstandard is None:
+        x_it(1, "zstd archive requires the Python 'zstandard' module.")
+
     # testing four deduplication types:
     dedup_idx     = dedup_db = None
     dedup         = options.dedup
     if dedup == 3: # sql
         dedup_db  = aset.hashindex
         cursor    = dedup_db.cursor()
-        c_uint64  = ctypes.c_uint64
-        c_int64   = ctypes.c_int64
+        # New hashes wait here for a batch insert; also searched for links.
+        dd_pending= {}
+        insert_phrase = "INSERT INTO hashindex(id,chunk,ses_id) VALUES(?,?,?)"
     elif dedup == 4: # array tree
-        hashtree, ht_ksize, hashdigits, hash_w, hash0len, \
-        dataf, chtree, chdigits, ch_w, ses_w \
+        hashtree, ht_bits, hashdigits, hash_w, hash0len, \
+        dataf, chtree, chdigits, ch_w, ses_w, bloom \
                   = aset.hashindex
-        ht_ksize  = ht_ksize//2
+        ht_shift  = 32 - ht_bits
         hsegs     = hash_w//hash0len
         chtree_max= 2**(chtree[0].itemsize*8)
         idxcount  = dataf.tell() // (ch_w+ses_w)
     elif dedup == 5: # bytearray tree
-        hashtree, ht_ksize, hashdigits, hash_w, \
-        dataf, chtree, chdigits, ch_w, ses_w \
+        hashtree, ht_bits, hashdigits, hash_w, \
+        dataf, chtree, chdigits, ch_w, ses_w, bloom \
                   = aset.hashindex
         chtree_max= 2**(chtree[0].itemsize*8)
-        ht_ksize  = ht_ksize//2
+        ht_shift  = 32 - ht_bits
         idxcount  = dataf.tell() // (ch_w+ses_w)
+    elif dedup == 6: # open-addressed table
+        tbl, mask, dataf, hash_w, chdigits, ch_w, ses_w \
+                  = aset.hashindex
+        rec_w     = hash_w+ses_w+ch_w
+        idxcount  = dataf.tell() // rec_w
 
     ses = vol.new_session(bksession)
     ses.localtime = localtime
     ses.volsize   = snap2size
     ses.format    = "tar" if options.tarfile else "folders"
     ses.path      = vol.path+"/"+bksession+"-tmp"
-    ses_index     = allsessions.index(ses)
+    ses_index     = len(allsessions) - 1
 
     # Set current dir and make new session folder
     os.chdir(metadir+bkdir)
     os.makedirs(sdir+"-tmp")
 
-    zeros     = bytes(chunksize)
     bcount    = ddbytes = 0
     addrsplit = -address_split[1]
     lchunk_addr = last_chunk_addr(snap2size, chunksize)
@@ -856,11 +1115,6 @@ def send_volume(datavol, localtime):
             print("  Volume size has increased.")
             sendall_addr = next_chunk_addr
 
-    if aset.compression=="zlib":
-        compress = zlib.compress
-    # add zstd here.
-    compresslevel = int(aset.compr_level)
-
     # Use tar to stream files to destination
     stream_started = False
     untar_cmd = destcd \
@@ -881,143 +1135,160 @@ def send_volume(datavol, localtime):
          open("/dev/zero" if send_all else vol.mapfile+"-tmp","r+b") as bmapf:
 
         bmap_mm = bytes(1) if send_all else mmap.mmap(bmapf.fileno(), 0)
-        vf_seek = vf.seek; vf_read = vf.read
-        sha256 = hashlib.sha256; BytesIO = io.BytesIO
 
         # Show progress in increments determined by 1000/checkpt_pct
         # where '200' results in five updates i.e. in unattended mode.
         checkpt = checkpt_pct = 335 if options.unattended else 1
         percent = 0
 
-        # Cycle over range of addresses in volume.
-        for addr in range(0, snap2size, chunksize):
+        # Send chunk if its bit is on in the deltamap or its above the
+        # send-all line.
+        send_addrs = bmap_addrs(bmap_mm, chunksize, snap2size, sendall_addr)
+
+        for addr, buf, bhashb in compress_chunks(vf, send_addrs, chunksize,
+                                                 lchunk_addr):
 
             # Calculate corresponding position in bitmap.
-            chunk = addr // chunksize
-            bmap_pos = chunk // 8
-            b = chunk % 8
-
-            # Send chunk if its above the send-all line
-            # or its bit is on in the deltamap.
-            if addr >= sendall_addr or bmap_mm[bmap_pos] & (1 << b):
-
-                vf_seek(addr)
-                buf = vf_read(chunksize)
-                destfile = "x"+chformat % addr
-
-                # Start tar stream
-                if not stream_started:
-                    untar = subprocess.Popen(dest_run_args(desttype, untar_cmd),
-                            stdin =subprocess.PIPE,    stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL)
-                    tarf = tarfile.open(mode="w|", fileobj=untar.stdin)
-                    tarf_addfile = tarf.addfile; TarInfo = tarfile.TarInfo
-                    LNKTYPE = tarfile.LNKTYPE
-                    stream_started = True
-
-                # Show progress.
-                percent = int(bmap_pos/bmap_size*1000)
-                if percent >= checkpt:
-                    print("  %.1f%%   %dMB " % (percent/10, bcount//1000000),
-                          end="\x0d", flush=True)
-                    checkpt += checkpt_pct
-
-                # Compress & write only non-empty and last chunks
-                if buf == zeros and addr < lchunk_addr:
-                    print("0", destfile, file=hashf)
-                    continue
-
-                # Performance fix: move compression into separate processes
-                buf      = compress(buf, compresslevel)
-                bhash    = sha256(buf)
-                # Add buffer to stream
-                tar_info = TarInfo("%s-tmp/%s/%s" % 
-                                (sdir, destfile[1:addrsplit], destfile))
-                print(bhash.hexdigest(), destfile, file=hashf)
-
-                # If chunk already in archive, link to it
-                if not dedup:
-                    pass
-
-                elif dedup == 3:
-                    bhashb = bhash.digest()
-                    row    = cursor.execute("SELECT chunk,ses_id FROM hashindex "
-                            "WHERE id = ?", (bhashb,)).fetchone()
-                    if row:
-                        ddch, ddses_i = row
-                        ddses = allsessions[ddses_i]
-                        ddchx = chformat % (c_uint64(ddch).value)
-                        tar_info.type = LNKTYPE
-                    else:
-                        # perf fix: use execute_many + index of waiting inserts
-                        cursor.execute("INSERT INTO hashindex(id,chunk,ses_id)"
-                            " VALUES(?,?,?)", 
-                            (bhashb, c_int64(addr).value, ses_index))
-
-                elif dedup == 4:
-                    bhashb = bhash.digest()
-                    i      = int.from_bytes(bhashb[:ht_ksize], "big")
-                    ht     = hashtree[i]; ct = chtree[i]
-                    while True:
-                        try:
-                            pos = ht.index(int.from_bytes(bhashb[:hash0len],
-                                                        "little"))
-                        except ValueError:
-                            if idxcount < chtree_max:
-                                hashtree[i].frombytes(bhashb)
-                                chtree[i].append(idxcount)
-                                dataf.write(ses_index.to_bytes(ses_w,"big"))
-                                dataf.write(addr.to_bytes(ch_w,"big"))
-                                idxcount += 1
-                                break # while
-
-                        if pos % hsegs == 0 and \
-                            ht[pos+1:pos+hsegs].tobytes() == bhashb[hash0len:]:
-                            # First hash segment matched; test remaining segments.
-                            data_i = ct[pos//hsegs]
-                            dataf.seek(data_i*(ses_w+ch_w))
-                            ddses  = allsessions[int.from_bytes(
-                                     dataf.read(ses_w),"big")]
-                            ddchx  = dataf.read(ch_w).hex().zfill(chdigits)
-                            dataf.seek(0,2)
-                            tar_info.type = LNKTYPE
-                            break # while
+            bmap_pos = addr // chunksize // 8
+            destfile = "x"+chformat % addr
+
+            # Start tar stream
+            if not stream_started:
+                untar = subprocess.Popen(dest_run_args(desttype, untar_cmd),
+                        stdin =subprocess.PIPE,    stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL, bufsize=1024*1024)
+                set_pipe_size(untar.stdin)
+                tarf = tarfile.open(mode="w|", fileobj=untar.stdin)
+                tar_tmpl = tarfile.TarInfo().tobuf(tarf.format,
+                                                   tarf.encoding, tarf.errors)
+                TarInfo = tarfile.TarInfo; LNKTYPE = tarfile.LNKTYPE
+                stream_started = True
+
+            # Show progress.
+            percent = int(bmap_pos/bmap_size*1000)
+            if percent >= checkpt:
+                print("  %.1f%%   %dMB " % (percent/10, bcount//1000000),
+                      end="\x0d", flush=True)
+                checkpt += checkpt_pct
+
+            # Write only non-empty and last chunks
+            if buf is None:
+                print("0", destfile, file=hashf)
+                continue
+
+            # Add buffer to stream
+            tar_info = TarInfo("%s-tmp/%s/%s" % 
+                            (sdir, destfile[1:addrsplit], destfile))
+            print(bhashb.hex(), destfile, file=hashf)
 
-                        pos += hsegs - (pos % hsegs)
-                        ht = ht[pos:]; ct = ct[pos//hsegs:]
+            # If chunk already in archive, link to it
+            if not dedup:
+                pass
 
-                elif dedup == 5:
-                    bhashb = bhash.digest()
-                    i      = int.from_bytes(bhashb[:ht_ksize], "big")
+            elif dedup == 3:
+                if bhashb in dd_pending:
+                    row = (dd_pending[bhashb], ses_index)
+                else:
+                    row = cursor.execute("SELECT chunk,ses_id FROM hashindex "
+                          "WHERE id = ?", (bhashb,)).fetchone()
+                if row:
+                    ddch, ddses_i = row
+                    ddses = allsessions[ddses_i]
+                    ddchx = chformat % (ddch & max_address)
+                    tar_info.type = LNKTYPE
+                else:
+                    dd_pending[bhashb] = int64_sql(addr)
+                    if len(dd_pending) >= 2000:
+                        cursor.executemany(insert_phrase, [(k, v, ses_index)
+                                           for k, v in dd_pending.items()])
+                        dd_pending.clear()
+
+            elif dedup == 4:
+                i      = hash_lead32(bhashb)[0] >> ht_shift
+                # Empty sequence skips the search for new hashes.
+                ht     = hashtree[i] if bloom_check_add(bloom, bhashb) else ()
+                ct     = chtree[i]
+                key    = hash_prefix(bhashb)[0]
+                start  = 0
+                while True:
+                    try:
+                        # array.index() has no start arg before Python 3.10
+                        pos = ht.index(key) if not start \
+                              else start + ht[start:].index(key)
+                    except ValueError:
+                        if idxcount < chtree_max:
+                            hashtree[i].frombytes(bhashb)
+                            chtree[i].append(idxcount)
+                            dataf.write(ses_index.to_bytes(ses_w,"big"))
+                            dataf.write(addr.to_bytes(ch_w,"big"))
+                            idxcount += 1
+                            break # while
 
-                    pos = hashtree[i].find(bhashb)
-                    if pos % hash_w == 0:
-                        data_i = chtree[i][pos//hash_w]
+                    if pos % hsegs == 0 and \
+                        ht[pos+1:pos+hsegs].tobytes() == bhashb[hash0len:]:
+                        # First hash segment matched; test remaining segments.
+                        data_i = ct[pos//hsegs]
                         dataf.seek(data_i*(ses_w+ch_w))
-                        ddses = allsessions[int.from_bytes(
-                                dataf.read(ses_w),"big")]
-                        ddchx = dataf.read(ch_w).hex().zfill(chdigits)
+                        ddses  = allsessions[int.from_bytes(
+                                 dataf.read(ses_w),"big")]
+                        ddchx  = dataf.read(ch_w).hex().zfill(chdigits)
                         dataf.seek(0,2)
                         tar_info.type = LNKTYPE
-                    elif idxcount < chtree_max:
-                        hashtree[i].extend(bhashb)
-                        chtree[i].append(idxcount)
-                        dataf.write(ses_index.to_bytes(ses_w,"big"))
-                        dataf.write(addr.to_bytes(ch_w,"big"))
-                        idxcount += 1
-
-                if tar_info.type == LNKTYPE:
-                    tar_info.linkname = "%s/%s/%s/x%s" % \
-                        (ddses.volume.name,
-                            ddses.name+"-tmp" if ddses==ses else ddses.name,
-                            ddchx[:addrsplit],
-                            ddchx)
-                    ddbytes += len(buf)
-                    tarf_addfile(tarinfo=tar_info)
+                        break # while
+
+                    start = pos + hsegs - (pos % hsegs)
+
+            elif dedup == 5:
+                i      = hash_lead32(bhashb)[0] >> ht_shift
+
+                pos = hashtree[i].find(bhashb) \
+                      if bloom_check_add(bloom, bhashb) else -1
+                if pos % hash_w == 0:
+                    data_i = chtree[i][pos//hash_w]
+                    dataf.seek(data_i*(ses_w+ch_w))
+                    ddses = allsessions[int.from_bytes(
+                            dataf.read(ses_w),"big")]
+                    ddchx = dataf.read(ch_w).hex().zfill(chdigits)
+                    dataf.seek(0,2)
+                    tar_info.type = LNKTYPE
+                elif idxcount < chtree_max:
+                    hashtree[i].extend(bhashb)
+                    chtree[i].append(idxcount)
+                    dataf.write(ses_index.to_bytes(ses_w,"big"))
+                    dataf.write(addr.to_bytes(ch_w,"big"))
+                    idxcount += 1
+
+            elif dedup == 6:
+                slot, rec = hashtbl_find(tbl, mask, bhashb, dataf, rec_w)
+                if rec:
+                    ddses = allsessions[int.from_bytes(
+                            rec[hash_w:hash_w+ses_w],"big")]
+                    ddchx = rec[hash_w+ses_w:].hex().zfill(chdigits)
+                    tar_info.type = LNKTYPE
                 else:
-                    tar_info.size = len(buf)
-                    tarf_addfile(tarinfo=tar_info, fileobj=BytesIO(buf))
-                    bcount += len(buf)
+                    hashtbl_set(tbl, slot, bhashb, idxcount)
+                    dataf.write(bhashb + ses_index.to_bytes(ses_w,"big")
+                                + addr.to_bytes(ch_w,"big"))
+                    idxcount += 1
+                    if idxcount > (mask+1) // 2:
+                        tbl, mask = hashtbl_grow(tbl, mask)
+                        aset.hashindex = (tbl, mask, dataf, hash_w,
+                                          chdigits, ch_w, ses_w)
+
+            if tar_info.type == LNKTYPE:
+                tar_info.linkname = "%s/%s/%s/x%s" % \
+                    (ddses.volume.name,
+                        ddses.name+"-tmp" if ddses==ses else ddses.name,
+                        ddchx[:addrsplit],
+                        ddchx)
+                ddbytes += len(buf)
+            else:
+                bcount += len(buf)
+            tar_add_chunk(tarf, tar_tmpl, tar_info, buf)
+
+        if dedup == 3 and dd_pending:
+            cursor.executemany(insert_phrase, [(k, v, ses_index)
+                               for k, v in dd_pending.items()])
 
     # Send session info, end stream and cleanup
     if stream_started:
@@ -1038,15 +1309,11 @@ def send_volume(datavol, localtime):
         #print("Ending tar process ", end="")
         tarf.close()
         untar.stdin.close()
-        for i in range(30):
-            if untar.poll() is not None:
-                break
-            time.sleep(1)
-        if untar.poll() is None:
-            time.sleep(5)
-            if untar.poll() is None:
-                untar.terminate()
-                print("terminated untar process!")
+        try:
+            untar.wait(timeout=35)
+        except subprocess.TimeoutExpired:
+            untar.terminate()
+            print("terminated untar process!")
 
         # Cleanup on VM/remote
         dest_run([ destcd + bkdir
@@ -1071,66 +1338,156 @@ def send_volume(datavol, localtime):
     return stream_started
 
 
+# Map unsigned 64bit chunk address to sqlite's signed INTEGER range;
+# read back with "& max_address".
+
+def int64_sql(addr):
+    return addr - 0x10000000000000000 if addr > 0x7fffffffffffffff else addr
+
+
+# Parse a session manifest into concatenated binary hashes and chunk
+# addresses, skipping empty chunks. Runs in worker processes.
+
+def parse_manifest(path):
+    with open(pjoin(path,"manifest"),"r") as manf:
+        fields = manf.read().split()
+    hashes = fields[0::2]; addrs = fields[1::2]
+    if "0" in hashes:
+        keep   = [x != "0" for x in hashes]
+        hashes = itertools.compress(hashes, keep)
+        addrs  = itertools.compress(addrs, keep)
+    # Decode each column with one call; addresses lose their "x" prefix.
+    return bytes.fromhex("".join(hashes)), \
+           bytes.fromhex("".join(addrs).replace("x",""))
+
+
+# Yield (sesnum, ses, hashes, addrs) for each session in order, except
+# those numbered in 'skip', while up to one manifest per CPU further along
+# is parsed in a pool of worker processes.
+
+def read_manifests(sessions, skip=()):
+    workers = os.cpu_count() or 1
+    pending = collections.deque()
+    # fork: a fresh interpreter would re-run this script's main section.
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        for sesnum, ses in enumerate(sessions):
+            if sesnum in skip:
+                continue
+            pending.append((sesnum, ses,
+                            pool.apply_async(parse_manifest, (ses.path,))))
+            if len(pending) > workers:
+                sesnum, ses, job = pending.popleft()
+                yield (sesnum, ses) + job.get()
+
+        while pending:
+            sesnum, ses, job = pending.popleft()
+            yield (sesnum, ses) + job.get()
+
+
+# Estimate number of indexed chunks from manifest sizes, as a non-zero
+# manifest line is 83 bytes.
+
+def est_manifest_entries(sessions):
+    return sum(os.stat(pjoin(ses.path,"manifest")).st_size
+               for ses in sessions) // 83
+
+
 # Build deduplication hash index and list
 
 def init_dedup_index3(listfile=""):
 
     addrsplit = -address_split[1]
     sessions  = aset.allsessions
-    c_int64   = ctypes.c_int64
     chdigits  = max_address.bit_length() // 4
     chformat  = "%0"+str(chdigits)+"x"
     ctime     = time.time()
+    dbpath    = metadir+bkdir+"/hashindex.db"
+
+    # The index persists between runs, along with the manifest stats of
+    # the sessions it covers. It is reused if all those sessions are
+    # still present and unchanged; their numbers are remapped to current
+    # positions and only other sessions are indexed. Otherwise, or for
+    # a listfile, the index is built anew.
+    # Chunks indexed during send are never committed, so a session that
+    # isn't finished leaves nothing behind.
+    seskeys = {}
+    for sesnum, ses in enumerate(sessions):
+        st = os.stat(pjoin(ses.path,"manifest"))
+        seskeys[(ses.path, st.st_mtime_ns, st.st_size)] = sesnum
 
-    db     = sqlite3.connect(tmpdir+"/hashindex.db")
-    #db    = sqlite3.connect(":memory:")
+    db = None
+    if not listfile and os.path.exists(dbpath):
+        try:
+            db     = sqlite3.connect(dbpath)
+            remap  = [(seskeys[tuple(row[:3])], row[3]) for row in
+                      db.execute("SELECT path,mtime,size,ses_id FROM sessions")]
+            rows   = db.execute("SELECT count(*) FROM hashindex").fetchone()[0]
+        except (sqlite3.DatabaseError, KeyError):
+            if db:
+                db.close()
+            db = None
+    if db is None:
+        if os.path.exists(dbpath):
+            os.remove(dbpath)
+        db     = sqlite3.connect(dbpath)
+        db.execute('''
+            CREATE TABLE hashindex(id BLOB PRIMARY KEY ON CONFLICT IGNORE,
+            chunk INTEGER, ses_id INTEGER
+            )''')
+        db.execute("CREATE TABLE sessions(path TEXT, mtime INTEGER,"
+                   " size INTEGER, ses_id INTEGER)")
+        remap = []; rows = 0
     cursor = db.cursor()
-    cursor.execute('''
-        CREATE TABLE hashindex(id BLOB PRIMARY KEY ON CONFLICT IGNORE,
-        chunk INTEGER, ses_id INTEGER
-        )''')
     insert_phrase = 'INSERT INTO hashindex(id, chunk, ses_id) VALUES(?,?,?)'
     cursor.execute('PRAGMA cache_size = 10000')
-    #cursor.execute('PRAGMA synchronous = OFF')
-    #cursor.execute('PRAGMA journal_mode = OFF')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+
+    if any(new != old for new, old in remap):
+        cursor.execute("CREATE TEMP TABLE sesmap(old INTEGER PRIMARY KEY,"
+                       " new INTEGER)")
+        cursor.executemany("INSERT INTO sesmap VALUES(?,?)",
+                           [(old, new) for new, old in remap])
+        for table in ("hashindex", "sessions"):
+            cursor.execute("UPDATE "+table+" SET ses_id ="
+                           " (SELECT new FROM sesmap WHERE old = ses_id)")
 
     if listfile:
         dedupf = open(tmpdir+"/"+listfile, "w")
 
-    inserts = []; rows = 0
-    for sesnum, ses in enumerate(sessions):
+    inserts = []
+    for sesnum, ses, hashes, addrs in read_manifests(sessions,
+                                        skip={new for new, old in remap}):
         volname = ses.volume.name; sesname = ses.name
-        with open(pjoin(ses.path,"manifest"),"r") as manf:
-            for ln in manf:
-                line = ln.strip().split()
-                if line[0] == "0":
-                    continue
-                bhash = bytes().fromhex(line[0])
-                uint  = int(line[1][1:],16)
-                addr  = c_int64(uint)
-
-                inserts.append((bhash, addr.value, sesnum))
-                # Insert only 1 at a time when generating a listfile.
-                if listfile or not len(inserts) % 2000:
-                    cursor.executemany(insert_phrase, inserts)
-                    rows += cursor.rowcount
-                    inserts.clear()
-
-                    if listfile and cursor.rowcount < 1:
-                        row = cursor.execute("SELECT chunk,ses_id FROM hashindex "
-                                "WHERE id = ?", (bhash,)).fetchone()
-                        if row:
-                            ddch, ddses_i = row
-                            ddses = sessions[ddses_i]
-                            ddchx = chformat % ddch
-                            print("%s/%s/%s/x%s %s/%s/%s/%s" % \
-                                (ddses.volume.name, ddses.name, ddchx[:addrsplit], ddchx,
-                                volname, sesname, line[1][1:addrsplit], line[1]),
-                                file=dedupf)
+        for n in range(len(addrs) // 8):
+            bhash = hashes[n*32:n*32+32]
+            addr  = int64_sql(int.from_bytes(addrs[n*8:n*8+8], "big"))
+
+            inserts.append((bhash, addr, sesnum))
+            # Insert only 1 at a time when generating a listfile.
+            if listfile or not len(inserts) % 2000:
+                cursor.executemany(insert_phrase, inserts)
+                rows += cursor.rowcount
+                inserts.clear()
+
+                if listfile and cursor.rowcount < 1:
+                    row = cursor.execute("SELECT chunk,ses_id FROM hashindex "
+                            "WHERE id = ?", (bhash,)).fetchone()
+                    if row:
+                        ddch, ddses_i = row
+                        ddses = sessions[ddses_i]
+                        ddchx = chformat % (ddch & max_address)
+                        ln2   = "x" + addrs[n*8:n*8+8].hex()
+                        print("%s/%s/%s/x%s %s/%s/%s/%s" % \
+                            (ddses.volume.name, ddses.name, ddchx[:addrsplit], ddchx,
+                            volname, sesname, ln2[1:addrsplit], ln2),
+                            file=dedupf)
 
     if len(inserts):
         cursor.executemany(insert_phrase, inserts)
         rows += cursor.rowcount
+    cursor.execute("DELETE FROM sessions")
+    cursor.executemany("INSERT INTO sessions VALUES(?,?,?,?)",
+                       [key + (sesnum,) for key, sesnum in seskeys.items()])
     db.commit()
     aset.hashindex = db
 
@@ -1139,14 +1496,38 @@ def init_dedup_index3(listfile=""):
 
     ####
     print("\nIndexed in %.1f seconds." % int(time.time()-ctime))
-    vsz, rss = map(int, os.popen("ps -up"+str(os.getpid())).readlines()[-1].split()[4:6])
+    vsz, rss = proc_mem_kb()
     print("\nMemory use: Max %dMB, index count: %d" %
-        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * resource.getpagesize() // 1024//1024,
+        (peak_mem_mb(),
         rows)
         )
     print("Current: vsize %d, rsize %d" % (vsz/1000,rss/1000))
 
 
+# Dedup keys from binary hashes: leading 32bits big-endian for tree
+# buckets, and first 64bits little-endian as array or table prefix.
+
+hash_lead32  = struct.Struct(">I").unpack_from
+hash_prefix  = struct.Struct("<Q").unpack_from
+
+
+# Bloom filter in front of dedup index 4 & 5 buckets: two bits taken from
+# separate slices of the hash, in a 4MB bitmap. A hash not seen before
+# usually finds a bit unset and skips the bucket search. Bits are set on
+# every check, as a miss is always followed by an insert.
+
+bloom_mask = 2**25 - 1
+bloom_keys = struct.Struct("<8xII").unpack_from
+
+def bloom_check_add(bloom, bhashb):
+    b1, b2 = bloom_keys(bhashb)
+    b1 &= bloom_mask; b2 &= bloom_mask
+    present = bloom[b1 >> 3] & (1 << (b1 & 7)) \
+              and bloom[b2 >> 3] & (1 << (b2 & 7))
+    bloom[b1 >> 3] |= 1 << (b1 & 7); bloom[b2 >> 3] |= 1 << (b2 & 7)
+    return present
+
+
 def init_dedup_index4(listfile=""):
 
     ctime     = time.time()
@@ -1155,77 +1536,82 @@ def init_dedup_index4(listfile=""):
     hash_w     = hashdigits // 2
     hash0len   = 8        # "Q" ulonglong = 8bytes
     hsegs      = hash_w//hash0len
-    ht_ksize   = 4 # hex digits for tree key
-    hashtree   = [array("Q") for x in range(2**(ht_ksize*4))]
-    chtree     = [array("I") for x in range(2**(ht_ksize*4))]
-    chtree_max = 2**(chtree[0].itemsize*8) # "I" has 32bit range
+    bloom      = bytearray((bloom_mask+1) // 8)
     chdigits   = max_address.bit_length() // 4 # 4bits per digit
     ses_w = 2; ch_w = chdigits //2
     # limit number of sessions to ses_w + room for vol set:
     sessions   = aset.allsessions[:2**(ses_w*8)-(len(aset.vols))-1]
     addrsplit  = -address_split[1]
+    # Tree is keyed by leading hash bits, sized for ~8 hashes per bucket:
+    ht_bits    = min(20, max(8, (est_manifest_entries(sessions) // 8)
+                                .bit_length()))
+    ht_shift   = 32 - ht_bits
+    hashtree   = [array("Q") for x in range(2**ht_bits)]
+    chtree     = [array("I") for x in range(2**ht_bits)]
+    chtree_max = 2**(chtree[0].itemsize*8) # "I" has 32bit range
 
     dataf = open(tmpdir+"/hashindex.dat","w+b")
     if listfile:
         dedupf = open(tmpdir+"/"+listfile, "w")
 
     count = match = 0
-    for sesnum, ses in enumerate(sessions):
+    for sesnum, ses, hashes, addrs in read_manifests(sessions):
         volname = ses.volume.name; sesname = ses.name
-        with open(pjoin(ses.path,"manifest"),"r") as manf:
-            for ln in manf:
-                ln1, ln2 = ln.strip().split()
-                if ln1 == "0":
-                    continue
-                bhashb = bytes().fromhex(ln1)
-                #bhash = int(ln1[:hash0len*2], 16)
-                i      = int(ln1[:ht_ksize], 16)
-
-                ht = hashtree[i]; ct = chtree[i]
-                while True:
-                    try:
-                        pos = ht.index(int.from_bytes(bhashb[:hash0len],
-                                                      "little"))
-                    except ValueError:
-                        if count < chtree_max:
-                            hashtree[i].frombytes(bhashb)
-                            chtree[i].append(count)
-                            dataf.write(sesnum.to_bytes(ses_w,"big"))
-                            dataf.write(bytes().fromhex(ln2[1:]))
-                            count += 1
-                            break # while
-
-                    if pos % hsegs == 0 and \
-                       ht[pos+1:pos+hsegs].tobytes() == bhashb[hash0len:]:
-                        #First hash segment matched; test remaining segments.
-                        if listfile:
-                            data_i = ct[pos//hsegs]
-                            dataf.seek(data_i*(ses_w+ch_w))
-                            ddses  = sessions[int.from_bytes(
-                                     dataf.read(ses_w),"big")]
-                            ddchx  = dataf.read(ch_w).hex().zfill(chdigits)
-                            print("%s/%s/%s/x%s %s/%s/%s/%s" % \
-                                (ddses.volume.name, ddses.name, ddchx[:addrsplit], ddchx,
-                                volname, sesname, ln2[1:addrsplit], ln2),
-                                file=dedupf)
-                            dataf.seek(0,2)
-                        match += 1
+        for n in range(len(addrs) // ch_w):
+            bhashb = hashes[n*hash_w:n*hash_w+hash_w]
+            addrb  = addrs[n*ch_w:n*ch_w+ch_w]
+            i      = hash_lead32(bhashb)[0] >> ht_shift
+
+            # Empty sequence skips the search for new hashes.
+            ht    = hashtree[i] if bloom_check_add(bloom, bhashb) else ()
+            ct    = chtree[i]
+            key   = hash_prefix(bhashb)[0]
+            start = 0
+            while True:
+                try:
+                    # array.index() has no start arg before Python 3.10
+                    pos = ht.index(key) if not start \
+                          else start + ht[start:].index(key)
+                except ValueError:
+                    if count < chtree_max:
+                        hashtree[i].frombytes(bhashb)
+                        chtree[i].append(count)
+                        dataf.write(sesnum.to_bytes(ses_w,"big"))
+                        dataf.write(addrb)
+                        count += 1
                         break # while
 
-                    pos += hsegs - (pos % hsegs)
-                    ht = ht[pos:]; ct = ct[pos//hsegs:]
+                if pos % hsegs == 0 and \
+                   ht[pos+1:pos+hsegs].tobytes() == bhashb[hash0len:]:
+                    #First hash segment matched; test remaining segments.
+                    if listfile:
+                        data_i = ct[pos//hsegs]
+                        dataf.seek(data_i*(ses_w+ch_w))
+                        ddses  = sessions[int.from_bytes(
+                                 dataf.read(ses_w),"big")]
+                        ddchx  = dataf.read(ch_w).hex().zfill(chdigits)
+                        ln2    = "x" + addrb.hex()
+                        print("%s/%s/%s/x%s %s/%s/%s/%s" % \
+                            (ddses.volume.name, ddses.name, ddchx[:addrsplit], ddchx,
+                            volname, sesname, ln2[1:addrsplit], ln2),
+                            file=dedupf)
+                        dataf.seek(0,2)
+                    match += 1
+                    break # while
+
+                start = pos + hsegs - (pos % hsegs)
 
     if listfile:
         dedupf.close()
         dataf.close()
 
-    aset.hashindex = (hashtree, ht_ksize, hashdigits, hash_w, hash0len,
-                      dataf, chtree, chdigits, ch_w, ses_w)
+    aset.hashindex = (hashtree, ht_bits, hashdigits, hash_w, hash0len,
+                      dataf, chtree, chdigits, ch_w, ses_w, bloom)
 
     print("\n %d matches in %.1f seconds." % (match, int(time.time()-ctime)))
-    vsz, rss = map(int, os.popen("ps -up"+str(os.getpid())).readlines()[-1].split()[4:6])
+    vsz, rss = proc_mem_kb()
     print("\nMemory use: Max %dMB, index count: %d" %
-        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * resource.getpagesize() // 1024//1024,
+        (peak_mem_mb(),
          count)
         )
     print("Current: vsize %d, rsize %d" % (vsz/1000,rss/1000))
@@ -1237,68 +1623,177 @@ def init_dedup_index5(listfile=""):
     # Define arrays and element widths
     hashdigits = 256 // 4  # sha256 @4bits per hex digit
     hash_w     = hashdigits // 2
-    ht_ksize   = 4 # hex digits for tree key
-    hashtree   = [bytearray() for x in range(2**(ht_ksize*4))]
-    chtree     = [array("I") for x in range(2**(ht_ksize*4))]
-    chtree_max = 2**(chtree[0].itemsize*8) # "I" has 32bit range
+    bloom      = bytearray((bloom_mask+1) // 8)
     chdigits   = max_address.bit_length() // 4 # 4bits per digit
     ses_w = 2; ch_w = chdigits //2
     # limit number of sessions to ses_w range:
     sessions   = aset.allsessions[:2**(ses_w*8)-(len(aset.vols))-1]
     addrsplit  = -address_split[1]
+    # Tree is keyed by leading hash bits, sized for ~8 hashes per bucket:
+    ht_bits    = min(20, max(8, (est_manifest_entries(sessions) // 8)
+                                .bit_length()))
+    ht_shift   = 32 - ht_bits
+    hashtree   = [bytearray() for x in range(2**ht_bits)]
+    chtree     = [array("I") for x in range(2**ht_bits)]
+    chtree_max = 2**(chtree[0].itemsize*8) # "I" has 32bit range
 
     dataf  = open(tmpdir+"/hashindex.dat","w+b")
     if listfile:
         dedupf = open(tmpdir+"/"+listfile, "w")
 
     count = match = 0
-    for sesnum, ses in enumerate(sessions):
+    for sesnum, ses, hashes, addrs in read_manifests(sessions):
         volname = ses.volume.name; sesname = ses.name
-        with open(pjoin(ses.path,"manifest"),"r") as manf:
-            for ln in manf:
-                ln1, ln2 = ln.strip().split()
-                if ln1 == "0":
-                    continue
-                bhashb = bytes().fromhex(ln1)
-                i      = int(ln1[:ht_ksize], 16)
-                pos    = hashtree[i].find(bhashb)
-                if pos % hash_w == 0:
-                    match += 1
-                    if listfile:
-                        data_i = chtree[i][pos//hash_w]
-                        dataf.seek(data_i*(ses_w+ch_w))
-                        ddses  = sessions[int.from_bytes(
-                                 dataf.read(ses_w),"big")]
-                        ddchx  = dataf.read(ch_w).hex().zfill(chdigits)
-                        print("%s/%s/%s/x%s %s/%s/%s/%s" % \
-                            (ddses.volume.name, ddses.name, ddchx[:addrsplit], ddchx,
-                            volname, sesname, ln2[1:addrsplit], ln2),
-                            file=dedupf)
-                        dataf.seek(0,2)
-                elif count < chtree_max:
-                    hashtree[i].extend(bhashb)
-                    chtree[i].append(count)
-                    dataf.write(sesnum.to_bytes(ses_w,"big"))
-                    dataf.write(bytes().fromhex(ln2[1:]))
-                    count += 1
+        for n in range(len(addrs) // ch_w):
+            bhashb = hashes[n*hash_w:n*hash_w+hash_w]
+            addrb  = addrs[n*ch_w:n*ch_w+ch_w]
+            i      = hash_lead32(bhashb)[0] >> ht_shift
+            pos    = hashtree[i].find(bhashb) \
+                     if bloom_check_add(bloom, bhashb) else -1
+            if pos % hash_w == 0:
+                match += 1
+                if listfile:
+                    data_i = chtree[i][pos//hash_w]
+                    dataf.seek(data_i*(ses_w+ch_w))
+                    ddses  = sessions[int.from_bytes(
+                             dataf.read(ses_w),"big")]
+                    ddchx  = dataf.read(ch_w).hex().zfill(chdigits)
+                    ln2    = "x" + addrb.hex()
+                    print("%s/%s/%s/x%s %s/%s/%s/%s" % \
+                        (ddses.volume.name, ddses.name, ddchx[:addrsplit], ddchx,
+                        volname, sesname, ln2[1:addrsplit], ln2),
+                        file=dedupf)
+                    dataf.seek(0,2)
+            elif count < chtree_max:
+                hashtree[i].extend(bhashb)
+                chtree[i].append(count)
+                dataf.write(sesnum.to_bytes(ses_w,"big"))
+                dataf.write(addrb)
+                count += 1
 
     if listfile:
         dedupf.close()
         dataf.close()
 
-    aset.hashindex = (hashtree, ht_ksize, hashdigits, hash_w,
-                      dataf, chtree, chdigits, ch_w, ses_w)
+    aset.hashindex = (hashtree, ht_bits, hashdigits, hash_w,
+                      dataf, chtree, chdigits, ch_w, ses_w, bloom)
 
     print("\nIndexed in %.1f seconds." % int(time.time()-ctime))
-    vsz, rss = map(int, os.popen("ps -up"+str(os.getpid())).readlines()[-1].split()[4:6])
+    vsz, rss = proc_mem_kb()
     print("\nMemory use: Max %dMB, index count: %d, matches: %d" %
-        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * resource.getpagesize() // 1024//1024,
+        (peak_mem_mb(),
          count, match)
         )
     print("Current: vsize %d, rsize %d" % (vsz/1000,rss/1000))
     #print("idx size: %d" % sys.getsizeof(idx))
 
 
+# Dedup index 6 is an open-addressed hash table in an anonymous mmap.
+# Slot i holds a 64bit hash prefix at tbl[i*2] and a data record number+1
+# at tbl[i*2+1], with 0 marking an empty slot. Records in dataf hold the
+# full hash, session index and chunk address; a prefix match is confirmed
+# against the full hash in the record.
+
+def hashtbl_new(slots):
+    return memoryview(mmap.mmap(-1, slots*16)).cast("Q"), slots-1
+
+
+# Returns the matching record, or None with the empty slot for inserting.
+
+def hashtbl_find(tbl, mask, bhashb, dataf, rec_w):
+    prefix = hash_prefix(bhashb)[0]
+    i      = prefix & mask
+    while tbl[i*2+1]:
+        if tbl[i*2] == prefix:
+            dataf.seek((tbl[i*2+1]-1) * rec_w)
+            rec = dataf.read(rec_w)
+            dataf.seek(0,2)
+            if rec.startswith(bhashb):
+                return i, rec
+        i = (i+1) & mask
+    return i, None
+
+
+def hashtbl_set(tbl, i, bhashb, data_i):
+    tbl[i*2]   = hash_prefix(bhashb)[0]
+    tbl[i*2+1] = data_i + 1
+
+
+# Double the table size, keeping load factor at or below 1/2.
+
+def hashtbl_grow(tbl, mask):
+    newtbl, newmask = hashtbl_new((mask+1) * 2)
+    for i in range(mask+1):
+        if tbl[i*2+1]:
+            j = tbl[i*2] & newmask
+            while newtbl[j*2+1]:
+                j = (j+1) & newmask
+            newtbl[j*2]   = tbl[i*2]
+            newtbl[j*2+1] = tbl[i*2+1]
+    return newtbl, newmask
+
+
+def init_dedup_index6(listfile=""):
+
+    ctime = time.time()
+    # Define table and record widths
+    hash_w     = 256 // 8 # sha256 bytes
+    chdigits   = max_address.bit_length() // 4 # 4bits per digit
+    ses_w = 2; ch_w = chdigits //2
+    rec_w      = hash_w+ses_w+ch_w
+    # limit number of sessions to ses_w range:
+    sessions   = aset.allsessions[:2**(ses_w*8)-(len(aset.vols))-1]
+    addrsplit  = -address_split[1]
+
+    # Size table for all manifest entries at half load so it rarely grows.
+    entries    = est_manifest_entries(sessions)
+    tbl, mask  = hashtbl_new(max(2**16, 1 << (entries*2).bit_length()))
+
+    dataf  = open(tmpdir+"/hashindex.dat","w+b")
+    if listfile:
+        dedupf = open(tmpdir+"/"+listfile, "w")
+
+    count = match = 0
+    for sesnum, ses, hashes, addrs in read_manifests(sessions):
+        volname = ses.volume.name; sesname = ses.name
+        for n in range(len(addrs) // ch_w):
+            bhashb = hashes[n*hash_w:n*hash_w+hash_w]
+            addrb  = addrs[n*ch_w:n*ch_w+ch_w]
+            slot, rec = hashtbl_find(tbl, mask, bhashb, dataf, rec_w)
+            if rec:
+                match += 1
+                if listfile:
+                    ddses  = sessions[int.from_bytes(
+                             rec[hash_w:hash_w+ses_w],"big")]
+                    ddchx  = rec[hash_w+ses_w:].hex().zfill(chdigits)
+                    ln2    = "x" + addrb.hex()
+                    print("%s/%s/%s/x%s %s/%s/%s/%s" % \
+                        (ddses.volume.name, ddses.name, ddchx[:addrsplit], ddchx,
+                        volname, sesname, ln2[1:addrsplit], ln2),
+                        file=dedupf)
+                continue
+
+            hashtbl_set(tbl, slot, bhashb, count)
+            dataf.write(bhashb + sesnum.to_bytes(ses_w,"big") + addrb)
+            count += 1
+            if count > (mask+1) // 2:
+                tbl, mask = hashtbl_grow(tbl, mask)
+
+    if listfile:
+        dedupf.close()
+        dataf.close()
+
+    aset.hashindex = (tbl, mask, dataf, hash_w, chdigits, ch_w, ses_w)
+
+    print("\nIndexed in %.1f seconds." % int(time.time()-ctime))
+    vsz, rss = proc_mem_kb()
+    print("\nMemory use: Max %dMB, index count: %d, matches: %d" %
+        (peak_mem_mb(),
+         count, match)
+        )
+    print("Current: vsize %d, rsize %d" % (vsz/1000,rss/1000))
+
+
 # Deduplicate data already in archive
 
 def dedup_existing():
@@ -1515,21 +2010,21 @@ def merge_sessions(datavol, sources, target, clear_sources=False):
     with open(pjoin(tmpdir,"sources.lst"), "w") as srcf:
         print(merge_target, target, file=srcf)
 
-        # Get manifests, append session name to eol, print session names to srcf.
+        # Select manifests, print session names to srcf.
         print("  Reading manifests")
         manifests = []
         for ses in merge_sources:
             if clear_sources:
                 print(ses, file=srcf)
-                manifests.append("man."+ses)
-            do_exec([["sed", "-E", "s|$| "+ses+"|",
-                      pjoin(metadir+bkdir,datavol,ses+"/manifest")
-                    ]], cwd=tmpdir, out="man."+ses)
+                manifests.append(ses)
         print("###", file=srcf)
 
-    # Unique-merge filenames: one for rename, one for new full manifest.
-    do_exec([["sort", "-umd", "-k2,2"] + manifests],
-             out="manifest.tmp", cwd=tmpdir)
+    # Unique-merge filenames, with session name at eol: one for rename,
+    # one for new full manifest.
+    with open(pjoin(tmpdir,"manifest.tmp"), "w") as mf:
+        for cksum, faddr, ses in merge_manifests(pjoin(metadir+bkdir,datavol),
+                                                 manifests):
+            mf.write("%s %s %s\n" % (cksum, faddr, ses))
     do_exec([["sort", "-umd", "-k2,2", "manifest.tmp",
               pjoin(metadir+bkdir,datavol,merge_target+"/manifest")
             ]], out="manifest.new", cwd=tmpdir)
@@ -1588,6 +2083,38 @@ def merge_sessions(datavol, sources, target, clear_sources=False):
 
     do_exec([["sync", "-f", "volinfo"]])
 
+# Merge the manifests of 'sessions' (newest first) in 'voldir', yielding
+# (cksum, faddr, ses) in address order with the newest entry for each
+# address. Each manifest is already in address order.
+
+def merge_manifests(voldir, sessions):
+    def entries(sesnum, ses):
+        with open(pjoin(voldir, ses, "manifest"), "r") as mf:
+            for ln in mf:
+                cksum, faddr = ln.split()
+                yield faddr, sesnum, cksum, ses
+
+    last = None
+    for faddr, sesnum, cksum, ses in heapq.merge(*itertools.starmap(
+                                            entries, enumerate(sessions))):
+        if faddr != last:
+            last = faddr
+            yield cksum, faddr, ses
+
+
+# Size prefix of each chunk sent by dest helper 'receive'.
+
+frame_size = struct.Struct(">I").unpack_from
+
+
+# Chunk job for receive_volume's thread pool: hash the buffer, and only if
+# it matches digest 'cksum' decompress it. Returns (hash, data or None).
+
+def verify_chunk(buf, cksum, decompress):
+    bhash = hashlib.sha256(buf).digest()
+    return bhash, decompress(buf) if bhash == cksum else None
+
+
 # Receive volume from archive. If no save_path specified, then verify only.
 # If diff specified, compare with current source volume; with --remap option
 # can be used to resync volume with archive if the deltamap or snapshots
@@ -1595,9 +2122,9 @@ def merge_sessions(datavol, sources, target, clear_sources=False):
 
 def receive_volume(datavol, select_ses="", save_path="", diff=False):
 
-    def diff_compare(dbuf,z):
+    def diff_compare(dbuf,z,addr):
         if dbuf != cmpf.read(chunksize):
-            print("* delta", faddr, "Z   " if z else "    ")
+            print("* delta", chformat % addr, "Z   " if z else "    ")
             if remap:
                 volsegment = addr // chunksize 
                 bmap_pos = volsegment // 8
@@ -1606,6 +2133,47 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
         else:
             return 0
 
+    # Save chunks queued as (addr, buf) in a separate thread, so a slow
+    # volume doesn't hold up receiving; None ends the queue. Every 64MB,
+    # writeback of the data saved so far is started and its pages released
+    # so a large restore doesn't fill memory. After an error the queue is
+    # still drained, so the receive loop can't block on it.
+    def save_chunks():
+        savefd    = savef.fileno()
+        save_done = 0
+        try:
+            for addr, buf in iter(saveq.get, None):
+                view = memoryview(buf)
+                pos  = 0
+                while pos < len(buf):
+                    pos += os.pwrite(savefd, view[pos:], addr+pos)
+
+                if addr - save_done >= 64*1024*1024:
+                    os.posix_fadvise(savefd, save_done, addr - save_done,
+                                     os.POSIX_FADV_DONTNEED)
+                    save_done = addr
+        except Exception as e:
+            save_errors.append(e)
+            for item in iter(saveq.get, None):
+                pass
+
+    # Compare a run of 'count' zero chunks at 'addr' in large reads; only a
+    # block that differs is compared again chunk by chunk.
+    def diff_zeros(addr, count):
+        delta = 0
+        end   = min(addr + count*chunksize, volsize)
+        while addr < end:
+            size = min(len(zeros_blk), end - addr)
+            if cmpf.read(size) != (zeros_blk if size == len(zeros_blk)
+                                   else bytes(size)):
+                cmpf.seek(addr)
+                for zaddr in range(addr, addr+size, chunksize):
+                    delta += diff_compare(zeros if zaddr < lchunk_addr
+                                          else bytes(volsize-zaddr),
+                                          True, zaddr)
+            addr += size
+        return delta
+
     verify_only = options.action == "verify"
     assert not (verify_only and (diff or save_path))
     attended    = not options.unattended
@@ -1630,10 +2198,9 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
     else:
         x_it(1, "No sessions available.")
 
-    if aset.compression in {"zlib","gzip"}:
-        decompress  = zlib.decompress
-        decomp_bits = 32 + zlib.MAX_WBITS
-    # add zstd here.
+    if aset.compression == "zstd" and zstandard is None:
+        x_it(1, "zstd archive requires the Python 'zstandard' module.")
+    decompress = get_decompressor(aset.compression, chunksize)
 
     if save_path and os.path.exists(save_path) and attended:
         print("\n!! This will erase all existing data in",save_path,"!!")
@@ -1646,10 +2213,11 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
     chformat    = "x%0"+str(chdigits)+"x"
     lchunk_addr = last_chunk_addr(volsize, chunksize)
     last_chunkx = chformat % lchunk_addr
-    open(tmpdir+"/manifests.cat", "wb").close()
+    addrsplit   = -address_split[1]
 
-    # Collect session manifests
+    # Collect session manifests, newest first
     include = False
+    merge_ses = []
     for ses in reversed(sessions):
         if ses == select_ses:
             include = True
@@ -1659,23 +2227,27 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
         if vol.sessions[ses].format == "tar":
             raise NotImplementedError(
                 "Receive from tarfile not yet implemented: "+ses)
-
-        # add session column to end of each line:
-        do_exec([["sed", "-E", "s|$| "+ses+"|", pjoin(ses,"manifest")]],
-                cwd=pjoin(metadir+bkdir,datavol), out=">>"+tmpdir+"/manifests.cat")
-
-    # Merge manifests and send to archive system:
-    # sed is used to expand chunk info into a path and filter out any entries
-    # beyond the current last chunk, then piped to cat on destination.
-    # Note address_split is used to bisect filename to construct the subdir.
-    cmds = [["sort", "-u", "-d", "-k2,2", tmpdir+"/manifests.cat"],
-            ["tee", tmpdir+"/manifest.verify"],
-            ["sed", "-E", "s|^\S+\s+x(\S{" + str(address_split[0]) + "})(\S+)\s+"
-            +"(S_\S+)|\\3/\\1/x\\1\\2|;"
-            +" /"+last_chunkx+"/q"],
-            dest_run_args(desttype, ["cat >"+tmpdir+"/rpc/dest.lst"])
-           ]
-    do_exec(cmds, cwd=pjoin(metadir+bkdir,datavol))
+        merge_ses.append(ses)
+
+    # Merge manifests and send to archive system: chunk digests are kept
+    # in memory for verification (None for empty chunks), and paths of
+    # non-empty chunks up to the current last chunk are listed for the
+    # destination, which sends only those.
+    # Note addrsplit is used to bisect filename to construct the subdir.
+    digests = []
+    with open(tmpdir+"/dest.lst", "w") as lstf:
+        for cksum, faddr, ses in merge_manifests(pjoin(metadir+bkdir,datavol),
+                                                 merge_ses):
+            if faddr != chformat % (len(digests) * chunksize):
+                raise ValueError("Bad fname "+faddr)
+            if cksum == "0":
+                digests.append(None)
+            else:
+                digests.append(bytes.fromhex(cksum))
+                lstf.write("%s/%s/%s\n" % (ses, faddr[1:addrsplit], faddr))
+            if faddr == last_chunkx:
+                break
+    dest_run(["cat >"+tmpdir+"/rpc/dest.lst"], infile=tmpdir+"/dest.lst")
 
     # Prepare save volume
     if save_path:
@@ -1700,10 +2272,18 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
         and stat.S_ISBLK(os.stat(save_path).st_mode):
             do_exec([["blkdiscard", save_path]])
             savef = open(save_path, "w+b")
-        else: # file
+            # Drop any cached pages from before the discard.
+            os.posix_fadvise(savef.fileno(), 0, volsize,
+                             os.POSIX_FADV_DONTNEED)
+        else: # file; left sparse so zero chunks take no space
             savef = open(save_path, "w+b")
-            savef.truncate(0)          ; savef.flush()
-            savef.truncate(volsize)    ; savef.flush()
+            os.ftruncate(savef.fileno(), volsize)
+        os.posix_fadvise(savef.fileno(), 0, volsize, os.POSIX_FADV_SEQUENTIAL)
+
+        saveq       = queue.Queue(16)
+        save_errors = []
+        saver       = threading.Thread(target=save_chunks, daemon=True)
+        saver.start()
         print("Saving to", save_path)
 
     elif diff:
@@ -1732,6 +2312,7 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
 
         cmpf  = open(pjoin("/dev",vgname,snap1vol), "rb")
         diff_count = 0
+        zeros_blk  = bytes(max(1, (16*1024*1024) // chunksize) * chunksize)
 
     print("\nReceiving volume", datavol, select_ses)
     # Create retriever process using py program
@@ -1739,66 +2320,100 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
             [destcd + bkdir+"/"+datavol
             +"  && python3 "+tmpdir+"/rpc/dest_helper.py receive"
             ])
-    getvol = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    getvol = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                              bufsize=max(1024*1024, chunksize*4))
+    set_pipe_size(getvol.stdout)
+
+    # Read chunks from getvol along with their manifest entries, and start
+    # verifying and decompressing each one in a thread pool (hashlib and
+    # the decompressors release the GIL). Entries are yielded in order once
+    # 'depth' later chunks have been read as (addr, zcount, buf, job);
+    # consecutive empty chunks are coalesced into one entry with 'zcount'
+    # set and no buffer or job.
+    # Chunks are read into a ring of depth+2 buffers: a buffer comes round
+    # again only after its entry has left 'pending' and been processed.
+    def read_chunks(pool, depth):
+        pending = collections.deque()
+        bufs    = [bytearray(chunksize + (chunksize // 1024))
+                   for i in range(depth + 2)]
+        bufnum  = 0
+        hdr     = bytearray(4)
+        for addr, digest in zip(range(0, volsize, chunksize), digests):
+            if digest is None:
+                # Empty chunk; nothing is sent for it.
+                if pending and pending[-1][1]:
+                    zaddr, zcount = pending[-1][:2]
+                    pending[-1] = (zaddr, zcount+1, None, None)
+                else:
+                    pending.append((addr, 1, None, None))
 
-    # Open manifest then receive, check and save data
-    with open(tmpdir+"/manifest.verify", "r") as mf:
-        for addr in range(0, volsize, chunksize):
-            faddr = chformat % addr
-            if attended:
-                print(int(addr/volsize*100),"%  ",faddr,end="  ")
+            else:
+                # Read chunk size
+                if getvol.stdout.readinto(hdr) != 4:
+                    break
+                untrusted_size, = frame_size(hdr)
 
-            cksum, fname, ses = mf.readline().strip().split()
-            if fname != faddr:
-                raise ValueError("Bad fname "+fname)
+                # allow for slight expansion from compression algo
+                if untrusted_size > chunksize + (chunksize // 1024) \
+                    or untrusted_size < 1:
+                        raise BufferError("Bad chunk size: %d" % untrusted_size)
 
-            # Read chunk size
-            untrusted_size = int.from_bytes(getvol.stdout.read(4),"big")
+                # Size is OK.
+                size = untrusted_size
 
-            if cksum.strip() == "0":
-                if untrusted_size != 0:
-                    raise ValueError("Expected size 0, got %d at %s %s." 
-                                     % (untrusted_size, ses, fname))
+                # Read chunk buffer
+                untrusted_buf = memoryview(bufs[bufnum])[:size]
+                bufnum = (bufnum + 1) % len(bufs)
+                got = getvol.stdout.readinto(untrusted_buf)
+                if getvol.poll() is not None and got == 0:
+                    break
 
+                if got != size:
+                    with open(tmpdir+"/bufdump", "wb") as dump:
+                        dump.write(untrusted_buf[:got])
+                    raise BufferError("Got %d bytes, expected %d"
+                                      % (got, size))
+                pending.append((addr, 0, untrusted_buf,
+                                pool.submit(verify_chunk, untrusted_buf,
+                                            digest, decompress)))
+
+            if len(pending) > depth:
+                yield pending.popleft()
+        yield from pending
+
+    workers = os.cpu_count() or 1
+    depth   = max(2, min(workers * 4, (16 * 1024 * 1024) // chunksize))
+
+    # Show progress for a checked chunk, at most 100 times per second.
+    def show_progress(addr):
+        nonlocal progress_time
+        now = time.monotonic()
+        if now - progress_time >= 0.01:
+            print(int(addr/volsize*100),"%  ",chformat % addr," OK",end="\x0d")
+            progress_time = now
+
+    # Receive, check and save data
+    received = 0
+    progress_time = 0.0
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for addr, zcount, untrusted_buf, job in read_chunks(pool, depth):
+            if zcount:
+                received = min(addr + zcount*chunksize, volsize)
                 if attended:
-                    print("OK",end="\x0d")
-
-                if save_path:
-                    savef.seek(chunksize, 1)
+                    show_progress(addr)
 
                 if diff:
-                    diff_count += diff_compare(zeros,True)
+                    diff_count += diff_zeros(addr, zcount)
 
                 continue
 
-            # allow for slight expansion from compression algo
-            if untrusted_size > chunksize + (chunksize // 1024) \
-                or untrusted_size < 1:
-                    raise BufferError("Bad chunk size: %d" % untrusted_size)
-
-            # Size is OK.
-            size = untrusted_size
-
-            # Read chunk buffer
-            untrusted_buf = getvol.stdout.read(size)
-            rc  = getvol.poll()
-            if rc is not None and len(untrusted_buf) == 0:
-                break
-
-            if len(untrusted_buf) != size:
-                with open(tmpdir+"/bufdump", "wb") as dump:
-                    dump.write(untrusted_buf)
-                raise BufferError("Got %d bytes, expected %d"
-                                  % (len(untrusted_buf), size))
-            if cksum != hashlib.sha256(untrusted_buf).hexdigest():
+            bhash, untrusted_decomp = job.result()
+            if untrusted_decomp is None:
                 with open(tmpdir+"/bufdump", "wb") as dump:
                     dump.write(untrusted_buf)
-                raise ValueError("Bad hash "+fname
-                    +" :: "+hashlib.sha256(untrusted_buf).hexdigest())
+                raise ValueError("Bad hash "+chformat % addr+" :: "+bhash.hex())
 
-            # Proceed with decompress.
-            # fix for zstd support
-            untrusted_decomp = decompress(untrusted_buf, decomp_bits, chunksize)
+            # Check decompressed size.
             if len(untrusted_decomp) != chunksize and addr < lchunk_addr:
                 raise BufferError("Decompressed to %d bytes." % len(untrusted_decomp))
             if addr == lchunk_addr and len(untrusted_decomp) != volsize - lchunk_addr:
@@ -1806,27 +2421,37 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
 
             # Buffer is OK...
             buf = untrusted_decomp
+            received = addr + len(buf)
             if attended:
-                print("OK",end="\x0d")
+                show_progress(addr)
 
             if verify_only:
                 continue
 
             if save_path:
-                savef.write(buf)
+                if save_errors:
+                    break
+                saveq.put((addr, buf))
             elif diff:
-                diff_count += diff_compare(buf,False)
+                diff_count += diff_compare(buf,False,addr)
 
+        if save_path:
+            saveq.put(None) ; saver.join()
+            if save_errors:
+                raise save_errors[0]
+        if getvol.stdout.read(1):
+            raise BufferError("Unexpected data after last chunk.")
+        rc = getvol.poll()
         if rc is not None and rc > 0:
             raise RuntimeError("Error code from getvol process: "+str(rc))
-        if addr+len(buf) != volsize:
+        if received != volsize:
             raise ValueError("Received range %d does not match volume size %d."
-                             % (addr+len(buf), volsize))
+                             % (received, volsize))
         print("100%")
-        print("Received byte range:", addr+len(buf))
+        print("Received byte range:", received)
 
         if save_path:
-            savef.flush() ; savef.close()
+            savef.close()
             if returned_home:
                 if not lv_exists(vgname, snap1vol):
                     do_exec([["lvcreate", "-pr", "-kn",
@@ -1849,11 +2474,23 @@ def receive_volume(datavol, select_ses="", save_path="", diff=False):
                 x_it(1, "%d bytes differ." % diff_count)
 
 
+# Return vsize and rss of this process in KB.
+
+def proc_mem_kb():
+    with open("/proc/self/status") as f:
+        fields = dict(ln.split(":", 1) for ln in f if ":" in ln)
+    return int(fields["VmSize"].split()[0]), int(fields["VmRSS"].split()[0])
+
+
+# Return peak rss of this process in MB (ru_maxrss is in KB on Linux).
+
+def peak_mem_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
 def show_mem_stats():
-    vsz, rss = map(int, os.popen("ps -up"+str(os.getpid())).readlines()[-1].split()[4:6])
-    print("\nMemory use: Max %dMB" %
-        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * resource.getpagesize() // 1024//1024)
-        )
+    vsz, rss = proc_mem_kb()
+    print("\nMemory use: Max %dMB" % peak_mem_mb())
     print("Current: vsize %d, rsize %d" % (vsz/1000,rss/1000))
 
 
@@ -1888,6 +2525,8 @@ max_address           = 0xffffffffffffffff # 64bits
 # for 64bits, a subdir split of 9+7 allows 2048 files per dir:
 address_split         = [len(hex(max_address))-2-7, 7]
 pjoin                 = os.path.join
+volname_check         = re.compile(r"^[a-zA-Z0-9\+\._-]+$")
+bmap_nonzero          = re.compile(rb"[^\x00]+")
 shell_prefix          = "set -e && export LC_ALL=C\n"
 os.environ["LC_ALL"]  = "C"
 
@@ -1944,7 +2583,7 @@ parser.add_argument("--dest", default="",
 parser.add_argument("--subdir", default="",
                     help="Init: optional subdir for --dest")
 parser.add_argument("--compression", default="",
-                    help="Init: optional subdir for --dest")
+                    help="Init: compression type:level (zlib or zstd)")
 parser.add_argument("--chunk-factor", dest="chfactor", type=int,
                     help="Init: set chunk size to N*64kB")
 parser.add_argument("--testing-dedup", dest="dedup", type=int, default=0,
@@ -1959,7 +2598,8 @@ options = parser.parse_args()
 
 # Select dedup test algorithm.
 init_dedup_index = [None, None, None, init_dedup_index3,
-                    init_dedup_index4, init_dedup_index5][options.dedup]
+                    init_dedup_index4, init_dedup_index5,
+                    init_dedup_index6][options.dedup]
 monitor_only     = options.action == "monitor" # gather metadata without backing up
 volgroups        = get_lvm_vgs()
 aset             = None
@@ -2113,6 +2753,8 @@ elif options.action == "arch-delete":
 
     for dv in list(aset.vols):
         aset.delete_volume(dv)
+    if os.path.exists(pjoin(aset.path,"hashindex.db")):
+        os.remove(pjoin(aset.path,"hashindex.db"))
 
     print("\nDeleting entire archive...")
     cmd = [destcd
@@ -2134,4 +2776,4 @@ if options.action   == "index-test":
 
 
 
-print("\nDone.\n")\
+print("\nDone.\n")